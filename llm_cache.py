@@ -0,0 +1,289 @@
+import bisect
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import orjson
+from cachetools import TTLCache
+
+logger = logging.getLogger(__name__)
+
+class ExactMatchCache:
+    """
+    Cache of Gemini analysis results keyed by the exact request content
+
+    Entries live in an in-process TTL cache and, if a SQLite path is given,
+    are also persisted so hits survive restarts and are shared by workers.
+    """
+
+    def __init__(self, maxsize: int = 10_000, ttl: int = 3600, path: Optional[str] = None):
+        """
+        Args:
+            maxsize: Maximum number of entries kept in memory
+            ttl: Entry lifetime in seconds
+            path: Optional SQLite database file for persistence
+        """
+        self.ttl = ttl
+        self._memory: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self._db = None
+
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache "
+                "(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._db.commit()
+            logger.info(f"Persistent LLM cache enabled at {path}")
+
+    @staticmethod
+    def make_key(model: str, *parts: str) -> str:
+        """
+        Build a SHA-256 key over the model name and request parts
+
+        Args:
+            model: Gemini model name
+            parts: Texts that determine the response (e.g. policy, invoice)
+
+        Returns:
+            Hex digest of the canonical JSON encoding of the request
+        """
+        canonical = json.dumps([model, *parts], ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return the cached value for key, or None on a miss"""
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None or self._db is None:
+                return value
+
+            row = self._db.execute(
+                "SELECT value FROM llm_cache WHERE key = ? AND expires_at > ?",
+                (key, time.time())
+            ).fetchone()
+            if row is None:
+                return None
+
+            value = orjson.loads(row[0])
+            self._memory[key] = value
+            return value
+
+    def set(self, key: str, value: Dict[str, Any]) -> None:
+        """Store value under key in memory and, if enabled, on disk"""
+        with self._lock:
+            self._memory[key] = value
+            if self._db is None:
+                return
+
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO llm_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, orjson.dumps(value), time.time() + self.ttl)
+                )
+                self._db.commit()
+            except sqlite3.Error as e:
+                logger.error(f"Failed to persist LLM cache entry: {str(e)}")
+
+# sentence-transformers models, loaded once per process and shared by all caches
+_encoders: Dict[str, Any] = {}
+
+def _get_encoder(model_name: str) -> Any:
+    """Return the shared sentence-transformers model, loading it on first use"""
+    encoder = _encoders.get(model_name)
+    if encoder is None:
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        encoder = SentenceTransformer(model_name, device=device)
+        _encoders[model_name] = encoder
+        logger.info(f"Loaded embedding model {model_name} on {device}")
+    return encoder
+
+class _VectorIndex:
+    """
+    Inner-product index over unit vectors (inner product = cosine similarity)
+
+    Uses a faiss IndexFlatIP when faiss is installed, otherwise a numpy matrix.
+    The vectors are also kept as a numpy matrix so entries can be dropped.
+    """
+
+    def __init__(self, dimension: int):
+        try:
+            import faiss
+            self._faiss_module = faiss
+        except ImportError:
+            self._faiss_module = None
+        self._dimension = dimension
+        self._faiss = None
+        self._matrix = None
+        self._rebuild(None)
+
+    def _rebuild(self, matrix: Any) -> None:
+        self._matrix = matrix
+        if self._faiss_module is not None:
+            self._faiss = self._faiss_module.IndexFlatIP(self._dimension)
+            if matrix is not None:
+                self._faiss.add(matrix)
+
+    def add(self, vectors: Any) -> None:
+        import numpy as np
+        self._matrix = vectors if self._matrix is None else np.vstack((self._matrix, vectors))
+        if self._faiss is not None:
+            self._faiss.add(vectors)
+
+    def keep(self, start: int) -> None:
+        """Drop the first start vectors (the oldest), keeping ids in insertion order"""
+        self._rebuild(self._matrix[start:] if start < len(self._matrix) else None)
+
+    def search(self, vectors: Any) -> Tuple[Any, Any]:
+        """Return (best score, best id) arrays, one entry per query vector"""
+        if self._faiss is not None:
+            scores, ids = self._faiss.search(vectors, 1)
+            return scores[:, 0], ids[:, 0]
+
+        similarities = vectors @ self._matrix.T
+        ids = similarities.argmax(axis=1)
+        return similarities[range(len(ids)), ids], ids
+
+class _Scope:
+    """Index, values and insertion times of one semantic cache scope"""
+
+    def __init__(self, dimension: int):
+        self.index = _VectorIndex(dimension)
+        self.values: List[Dict[str, Any]] = []
+        self.inserted_at: List[float] = []
+
+class SemanticCache:
+    """
+    Near-duplicate lookup of analysis results by embedding similarity
+
+    Entries are grouped by scope (e.g. the exact-match key of the policy), so
+    only invoices checked against the same policy can match each other. Texts
+    are embedded with a shared sentence-transformers model as L2-normalized
+    vectors, so a lookup is a single inner-product search per scope. Like the
+    exact-match tier, each scope holds at most maxsize entries for ttl seconds.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.95,
+        model_name: str = "sentence-transformers/all-MiniLM-L6-v2",
+        maxsize: int = 10_000,
+        ttl: int = 3600
+    ):
+        """
+        Args:
+            threshold: Minimum cosine similarity for a hit
+            model_name: sentence-transformers model used for embeddings
+            maxsize: Maximum number of entries kept per scope
+            ttl: Entry lifetime in seconds
+        """
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._encoder = _get_encoder(model_name)
+        self._dimension = self._encoder.get_sentence_embedding_dimension()
+        self._lock = threading.Lock()
+        self._scopes: Dict[str, _Scope] = {}
+
+    def _encode(self, texts: List[str]) -> Any:
+        return self._encoder.encode(
+            texts,
+            batch_size=32,
+            normalize_embeddings=True,
+            convert_to_numpy=True
+        ).astype('float32')
+
+    def _prune(self, now: float) -> None:
+        """Drop expired and over-capacity entries, and scopes left empty; caller holds the lock"""
+        cutoff = now - self.ttl
+        for key in list(self._scopes):
+            scope = self._scopes[key]
+            # Entries are appended in time order, so expired ones form a prefix
+            start = bisect.bisect_right(scope.inserted_at, cutoff)
+            start = max(start, len(scope.values) - self.maxsize)
+            if start >= len(scope.values):
+                del self._scopes[key]
+            elif start > 0:
+                scope.index.keep(start)
+                del scope.values[:start]
+                del scope.inserted_at[:start]
+
+    def get_many(self, scope: str, texts: List[str]) -> List[Optional[Dict[str, Any]]]:
+        """Return the closest value in scope for each text, or None below the threshold"""
+        with self._lock:
+            self._prune(time.time())
+            if scope not in self._scopes or not texts:
+                return [None] * len(texts)
+
+        vectors = self._encode(texts)
+        with self._lock:
+            entry = self._scopes.get(scope)
+            if entry is None:
+                return [None] * len(texts)
+            # Resolve ids under the lock; pruning shifts them
+            scores, ids = entry.index.search(vectors)
+            results = []
+            for score, value_id in zip(scores, ids):
+                if score >= self.threshold:
+                    logger.debug("Semantic cache hit with similarity %.3f", score)
+                    results.append(entry.values[value_id])
+                else:
+                    results.append(None)
+        return results
+
+    def get(self, scope: str, text: str) -> Optional[Dict[str, Any]]:
+        """Return the value of the most similar entry in scope, if close enough"""
+        return self.get_many(scope, [text])[0]
+
+    def set_many(self, scope: str, texts: List[str], values: List[Dict[str, Any]]) -> None:
+        """Add texts and their values to scope, embedding them in one batch"""
+        if not texts:
+            return
+
+        vectors = self._encode(texts)
+        with self._lock:
+            now = time.time()
+            entry = self._scopes.get(scope)
+            if entry is None:
+                entry = self._scopes[scope] = _Scope(self._dimension)
+            entry.index.add(vectors)
+            entry.values.extend(values)
+            entry.inserted_at.extend([now] * len(values))
+            self._prune(now)
+
+    def set(self, scope: str, text: str, value: Dict[str, Any]) -> None:
+        """Add text and its value to scope"""
+        self.set_many(scope, [text], [value])
+
+def create_semantic_cache(
+    threshold: Optional[float],
+    maxsize: int = 10_000,
+    ttl: int = 3600
+) -> Optional[SemanticCache]:
+    """
+    Create a SemanticCache if enabled and sentence-transformers is installed
+
+    Args:
+        threshold: Similarity threshold; None disables the semantic cache
+        maxsize: Maximum number of entries kept per scope
+        ttl: Entry lifetime in seconds
+
+    Returns:
+        SemanticCache instance or None
+    """
+    if threshold is None:
+        return None
+
+    try:
+        return SemanticCache(threshold=threshold, maxsize=maxsize, ttl=ttl)
+    except ImportError:
+        logger.warning("sentence-transformers is not installed; semantic cache disabled")
+        return None
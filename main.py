@@ -1,16 +1,25 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi.responses import ORJSONResponse, HTMLResponse, Response
 import zipfile
-import io
 import os
 import random
-from typing import Dict, Any, List
-from utils import extract_text_from_docx, extract_text_from_pdf, load_prompt_template
+import hashlib
+import time
+import datetime
+from typing import Dict, Any, List, Optional, Tuple, BinaryIO
+from utils import extract_text_from_pdf, get_pdf_page_count, get_prompt_parts, parse_document, truncate_text
 import google.generativeai as genai
+from google.generativeai import caching
+from google.api_core import exceptions as google_exceptions
 from dotenv import load_dotenv
 import json
+import re
+import orjson
 import logging
 import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from llm_cache import ExactMatchCache, create_semantic_cache
 
 # Load environment variables
 load_dotenv()
@@ -19,82 +28,392 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Maximum number of concurrent Gemini requests per analysis
+MAX_CONCURRENT_ANALYSES = 8
+
+# Number of invoices sent to Gemini in a single request
+ANALYSIS_BATCH_SIZE = 5
+
+# Gemini model; context caching requires an explicit model version
+GEMINI_MODEL_NAME = "models/gemini-1.5-flash-002"
+
+# How long a cached policy prefix lives on the Gemini side
+POLICY_CACHE_TTL = datetime.timedelta(minutes=10)
+# Stop handing out a cache this long before it expires server-side
+POLICY_CACHE_EXPIRY_MARGIN = 60
+
+# Policy prefix hash -> (CachedContent, local expiry timestamp); a None cache
+# records a prefix that failed to cache (e.g. below Gemini's minimum token
+# count), so it is not retried until the entry expires
+_policy_caches: Dict[str, Tuple[Optional[caching.CachedContent], float]] = {}
+
+# Shared model instances; the client is created lazily after genai.configure()
+_model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+# CachedContent name -> model bound to that cache
+_cached_models: Dict[str, genai.GenerativeModel] = {}
+
+# Successful analyses keyed by (model, policy, invoice) content, so re-uploads skip Gemini.
+# Set LLM_CACHE_PATH to a SQLite file to keep them across restarts.
+ANALYSIS_CACHE_SIZE = 10_000
+ANALYSIS_CACHE_TTL = 3600  # seconds
+_analysis_cache = ExactMatchCache(
+    maxsize=ANALYSIS_CACHE_SIZE,
+    ttl=ANALYSIS_CACHE_TTL,
+    path=os.getenv("LLM_CACHE_PATH")
+)
+
+# Near-duplicate invoice cache, off unless SEMANTIC_CACHE_THRESHOLD is set (e.g. 0.95).
+# Invoices that differ only in amount or date embed very closely, so use with care.
+_semantic_threshold = os.getenv("SEMANTIC_CACHE_THRESHOLD")
+_semantic_cache = create_semantic_cache(
+    float(_semantic_threshold) if _semantic_threshold else None,
+    maxsize=ANALYSIS_CACHE_SIZE,
+    ttl=ANALYSIS_CACHE_TTL
+)
+
+# Upload limits; both .docx and .zip files are ZIP containers
+MAX_POLICY_FILE_SIZE = 10 * 1024 * 1024
+MAX_INVOICE_ZIP_SIZE = 100 * 1024 * 1024
+ZIP_MAGIC = b"PK\x03\x04"
+
+# Character limits on text sent to Gemini (roughly 30k and 8k tokens)
+MAX_POLICY_CHARS = 120_000
+MAX_INVOICE_CHARS = 32_000
+
+# Policies longer than this (roughly 10k tokens) are condensed once into a JSON
+# list of rules, which is sent in place of the full text; 0 disables this
+POLICY_COMPRESSION_MIN_CHARS = int(os.getenv("POLICY_COMPRESSION_MIN_CHARS", "40000"))
+# Longest policy text sent for compression (roughly 100k tokens)
+MAX_POLICY_COMPRESSION_INPUT_CHARS = 400_000
+POLICY_RULES_INSTRUCTION = (
+    "Extract every reimbursement rule from the company policy below as a JSON array "
+    "of objects with the keys \"category\", \"limit\" and \"condition\". Keep all "
+    "amounts, currencies, eligibility conditions and exclusions exactly as stated, and "
+    "omit text that does not affect reimbursement. Respond with the JSON array only."
+    "\n\n--- POLICY DOCUMENT ---\n"
+)
+
+# Markdown code fence Gemini sometimes wraps its JSON in
+_JSON_FENCE = re.compile(r'```(?:json)?\s*([\s\S]*?)\s*```')
+
+# Gemini errors that retrying cannot fix (bad key, missing permission, bad request)
+NON_RETRYABLE_ERRORS = (
+    google_exceptions.PermissionDenied,
+    google_exceptions.Unauthenticated,
+    google_exceptions.InvalidArgument
+)
+# Upper bound on a single backoff sleep, in seconds
+MAX_RETRY_DELAY = 30
+
+# Appended to every prompt to ask the model to revalidate its answer
+REVALIDATION_INSTRUCTION = "\nPlease double-check your analysis before responding."
+
+# Appended to batched prompts; the invoice section holds several invoices
+BATCH_INSTRUCTION = (
+    "\nThe invoice document above contains {count} invoices, each starting with an "
+    "'### INVOICE <n>: <filename>' header. Return a JSON array with exactly one object "
+    "per invoice, in the same order, each using the response format described above "
+    "with \"invoice\" set to the exact filename from that invoice's header."
+)
+
+# Worker processes for CPU-bound PDF text extraction
+_pdf_pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+
+# Bounds the single-use processes that retry calls lost to a broken pool
+_isolated_retry_slots = asyncio.Semaphore(os.cpu_count() or 1)
+
+# PDFs at least this large are split into page ranges extracted in parallel
+PDF_SPLIT_MIN_BYTES = 2 * 1024 * 1024
+PDF_PAGES_PER_TASK = 25
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Invoice Reimbursement Analysis API",
     description="Analyze invoice reimbursements against company policy using Google Gemini",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 @app.on_event("startup")
 async def startup_event():
     """Initialize the application on startup"""
     try:
-        # Test API connection
+        # Configure the client only; a real generation round-trip is left to /health/deep
         api_key = os.getenv("GEMINI_API_KEY")
         if not api_key:
             raise ValueError("GEMINI_API_KEY not found in environment variables")
         
+        # Default transports: gRPC for sync calls (context caching) and
+        # grpc_asyncio for generate_content_async, so all requests share one
+        # HTTP/2 channel per client; transport='grpc' would break the async client
         genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('gemini-1.5-flash')  # Using flash model
-        response = model.generate_content("Test connection")
-        logger.info("Successfully connected to Gemini API")
+        logger.info("Configured Gemini API client")
         
     except Exception as e:
         logger.error(f"Failed to initialize Gemini API: {str(e)}")
         raise
 
-async def analyze_invoice_with_gemini(policy_text: str, invoice_text: str, invoice_filename: str) -> Dict[str, Any]:
-    """Analyze a single invoice against the policy using Gemini"""
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Release worker processes on shutdown"""
+    _pdf_pool.shutdown(wait=False, cancel_futures=True)
+
+def build_policy_prefix(policy_text: str) -> Tuple[str, str]:
+    """
+    Build the policy-specific prompt prefix and the invoice suffix
+    
+    Returns:
+        Tuple of (policy_prefix, suffix); the full prompt for an invoice is
+        policy_prefix + invoice_text + suffix
+    """
+    prefix, middle, suffix = get_prompt_parts()
+    return ''.join((prefix, policy_text, middle)), suffix + REVALIDATION_INSTRUCTION
+
+def get_model(policy_cache: Optional[caching.CachedContent] = None) -> genai.GenerativeModel:
+    """Return the shared model, or the shared model bound to policy_cache"""
+    if policy_cache is None:
+        return _model
+    
+    model = _cached_models.get(policy_cache.name)
+    if model is None:
+        model = genai.GenerativeModel.from_cached_content(cached_content=policy_cache)
+        _cached_models[policy_cache.name] = model
+    return model
+
+def analysis_cache_key(policy_text: str, invoice_text: str) -> str:
+    """Build a content-addressed cache key for a (policy, invoice) pair"""
+    return ExactMatchCache.make_key(GEMINI_MODEL_NAME, policy_text, invoice_text)
+
+async def get_cached_analyses(policy_text: str, invoice_texts: List[str]) -> List[Optional[Dict[str, Any]]]:
+    """
+    Look up analyses in the exact-match cache, then the semantic cache
+    
+    Semantic lookups for all exact-match misses are embedded in one batch.
+    """
+    results = [_analysis_cache.get(analysis_cache_key(policy_text, text)) for text in invoice_texts]
+    
+    misses = [i for i, result in enumerate(results) if result is None]
+    if misses and _semantic_cache is not None:
+        policy_scope = ExactMatchCache.make_key(GEMINI_MODEL_NAME, policy_text)
+        hits = await asyncio.to_thread(
+            _semantic_cache.get_many, policy_scope, [invoice_texts[i] for i in misses]
+        )
+        for i, hit in zip(misses, hits):
+            results[i] = hit
+    
+    return results
+
+async def get_cached_analysis(policy_text: str, invoice_text: str) -> Optional[Dict[str, Any]]:
+    """Look up a single analysis in the response caches"""
+    return (await get_cached_analyses(policy_text, [invoice_text]))[0]
+
+async def cache_analyses(policy_text: str, invoice_texts: List[str], results: List[Dict[str, Any]]) -> None:
+    """Store successful analyses in the response caches"""
+    for text, result in zip(invoice_texts, results):
+        _analysis_cache.set(analysis_cache_key(policy_text, text), result)
+    
+    if invoice_texts and _semantic_cache is not None:
+        policy_scope = ExactMatchCache.make_key(GEMINI_MODEL_NAME, policy_text)
+        await asyncio.to_thread(_semantic_cache.set_many, policy_scope, invoice_texts, results)
+
+async def cache_analysis(policy_text: str, invoice_text: str, result: Dict[str, Any]) -> None:
+    """Store a single successful analysis in the response caches"""
+    await cache_analyses(policy_text, [invoice_text], [result])
+
+def get_policy_cache(policy_prefix: str) -> Optional[caching.CachedContent]:
+    """
+    Return a Gemini context cache holding the policy prefix
+    
+    Caches are reused across requests for the same policy until shortly before
+    their TTL expires. Returns None if the cache cannot be created (e.g. the
+    policy is below Gemini's minimum cacheable token count), in which case
+    callers send the full prompt instead. Failures are remembered for the TTL
+    so each request does not pay for another failing round-trip.
+    """
+    key = hashlib.sha256(policy_prefix.encode('utf-8')).hexdigest()
+    now = time.time()
+    expires_at = now + POLICY_CACHE_TTL.total_seconds() - POLICY_CACHE_EXPIRY_MARGIN
+    
+    entry = _policy_caches.get(key)
+    if entry and entry[1] > now:
+        return entry[0]
+    
+    # Drop expired entries; Gemini deletes the caches itself at TTL
+    for stale_key in [k for k, (_, expires) in _policy_caches.items() if expires <= now]:
+        stale_cache, _ = _policy_caches.pop(stale_key)
+        if stale_cache is not None:
+            _cached_models.pop(stale_cache.name, None)
+    
+    try:
+        cache = caching.CachedContent.create(
+            model=GEMINI_MODEL_NAME,
+            contents=[policy_prefix],
+            ttl=POLICY_CACHE_TTL
+        )
+    except Exception as e:
+        logger.warning(f"Policy context cache unavailable, sending full prompts: {str(e)}")
+        _policy_caches[key] = (None, expires_at)
+        return None
+    
+    _policy_caches[key] = (cache, expires_at)
+    logger.info(f"Created policy context cache: {cache.name}")
+    return cache
+
+async def compress_policy(policy_text: str) -> str:
+    """
+    Condense a long policy into a compact JSON list of rules
+    
+    The rules are extracted by one Gemini call per distinct policy and kept
+    in the analysis cache, so every invoice prompt (and the policy context
+    cache) carries the short version instead of the full document. When
+    compression fails or does not shrink the policy, that outcome is cached
+    too, so the policy is not sent for compression again on every request.
+    
+    Args:
+        policy_text: Extracted policy text
+        
+    Returns:
+        JSON-encoded rules, or the original text if the policy is short or
+        the extraction fails
+    """
+    if not POLICY_COMPRESSION_MIN_CHARS or len(policy_text) < POLICY_COMPRESSION_MIN_CHARS:
+        return policy_text
+    
+    cache_key = ExactMatchCache.make_key(GEMINI_MODEL_NAME, POLICY_RULES_INSTRUCTION, policy_text)
+    cached = _analysis_cache.get(cache_key)
+    if cached is not None:
+        # None records a policy that compression could not shrink
+        return cached["rules"] or policy_text
+    
+    compression_input = truncate_text(
+        policy_text, MAX_POLICY_COMPRESSION_INPUT_CHARS, "Policy text for compression"
+    )
+    
+    try:
+        response = await _model.generate_content_async(
+            [POLICY_RULES_INSTRUCTION, compression_input],
+            generation_config={"response_mime_type": "application/json"}
+        )
+        rules = parse_analysis_response(response.text)
+        if not isinstance(rules, list) or not rules or not all(isinstance(rule, dict) for rule in rules):
+            raise ValueError("Expected a non-empty JSON array of rule objects")
+    except Exception as e:
+        logger.warning(f"Policy compression failed, using full policy text: {str(e)}")
+        _analysis_cache.set(cache_key, {"rules": None})
+        return policy_text
+    
+    compressed = orjson.dumps(rules).decode()
+    if len(compressed) >= len(policy_text):
+        _analysis_cache.set(cache_key, {"rules": None})
+        return policy_text
+    
+    _analysis_cache.set(cache_key, {"rules": compressed})
+    logger.info(f"Compressed policy from {len(policy_text)} to {len(compressed)} characters ({len(rules)} rules)")
+    return compressed
+
+def parse_analysis_response(response_text: str) -> Any:
+    """
+    Extract the JSON payload from a Gemini response and parse it
+    
+    Raises:
+        json.JSONDecodeError: If the payload is not valid JSON
+    """
+    # Use the first fenced block if present, wherever it appears in the text
+    match = _JSON_FENCE.search(response_text)
+    payload = match.group(1) if match else response_text.strip()
+    
+    return orjson.loads(payload)
+
+def validate_analysis(result: Dict[str, Any], invoice_filename: str) -> Dict[str, Any]:
+    """
+    Normalize a single Gemini verdict into the response format
+    
+    Raises:
+        ValueError: If the verdict has an invalid status or amount
+    """
+    # Validate required fields and format
+    validated_result = {
+        "invoice_id": invoice_filename,
+        "reimbursement_status": result.get("reimbursement_status", "Declined"),
+        "reimbursable_amount": int(result.get("reimbursable_amount", 0)),
+        "reason": result.get("reason", "No reason provided")
+    }
+    
+    # Validate status values
+    valid_statuses = ["Fully Reimbursed", "Partially Reimbursed", "Declined"]
+    if validated_result["reimbursement_status"] not in valid_statuses:
+        raise ValueError(f"Invalid status: {validated_result['reimbursement_status']}")
+    
+    # Ensure reasonable amount
+    if validated_result["reimbursable_amount"] < 0:
+        raise ValueError("Negative reimbursement amount")
+    
+    # Verify reason includes policy reference
+    if "clause" not in validated_result["reason"].lower():
+        validated_result["reason"] += " (Based on policy analysis)"
+    
+    return validated_result
+
+async def generate_content(
+    model: genai.GenerativeModel,
+    prompt: Any,
+    semaphore: Optional[asyncio.Semaphore] = None
+) -> Any:
+    """
+    Send one Gemini request, holding a semaphore slot only while it is in flight
+    
+    Limiting each call rather than each batch keeps the number of concurrent
+    Gemini requests bounded even when batches fall back to per-invoice calls;
+    retry backoff sleeps happen outside the slot.
+    """
+    if semaphore is None:
+        return await model.generate_content_async(prompt)
+    
+    async with semaphore:
+        return await model.generate_content_async(prompt)
+
+async def analyze_invoice_with_gemini(
+    policy_text: str,
+    invoice_text: str,
+    invoice_filename: str,
+    policy_cache: Optional[caching.CachedContent] = None,
+    semaphore: Optional[asyncio.Semaphore] = None
+) -> Dict[str, Any]:
+    """
+    Analyze a single invoice against the policy using Gemini
+    
+    If policy_cache is given, the policy prefix is served from the Gemini
+    context cache and only the invoice text is sent with the request. If
+    semaphore is given, the Gemini call holds one of its slots.
+    """
+    cached_result = await get_cached_analysis(policy_text, invoice_text)
+    if cached_result is not None:
+        logger.debug("Using cached analysis for %s", invoice_filename)
+        return {**cached_result, "invoice_id": invoice_filename}
+    
     max_retries = 3
     retry_delay = 2
+    policy_prefix, suffix = build_policy_prefix(policy_text)
     
     for attempt in range(max_retries):
         try:
-            model = genai.GenerativeModel('gemini-1.5-flash')
-            prompt_template = load_prompt_template()
-            formatted_prompt = prompt_template.format(
-                policy_text=policy_text,
-                invoice_text=invoice_text
-            )
-            
-            # Request revalidation in the prompt
-            formatted_prompt += "\nPlease double-check your analysis before responding."
+            model = get_model(policy_cache)
+            if policy_cache is not None:
+                formatted_prompt = ''.join((invoice_text, suffix))
+            else:
+                formatted_prompt = ''.join((policy_prefix, invoice_text, suffix))
             
-            response = model.generate_content(formatted_prompt)
-            response_text = response.text.strip()
+            response = await generate_content(model, formatted_prompt, semaphore)
             
             # Clean and validate response
             try:
-                if response_text.startswith('```json'):
-                    response_text = response_text.replace('```json', '').replace('```', '').strip()
-                elif response_text.startswith('```'):
-                    response_text = response_text.replace('```', '').strip()
-                    
-                result = json.loads(response_text)
-                
-                # Validate required fields and format
-                validated_result = {
-                    "invoice_id": invoice_filename,
-                    "reimbursement_status": result.get("reimbursement_status", "Declined"),
-                    "reimbursable_amount": int(result.get("reimbursable_amount", 0)),
-                    "reason": result.get("reason", "No reason provided")
-                }
-                
-                # Validate status values
-                valid_statuses = ["Fully Reimbursed", "Partially Reimbursed", "Declined"]
-                if validated_result["reimbursement_status"] not in valid_statuses:
-                    raise ValueError(f"Invalid status: {validated_result['reimbursement_status']}")
-                
-                # Ensure reasonable amount
-                if validated_result["reimbursable_amount"] < 0:
-                    raise ValueError("Negative reimbursement amount")
-                
-                # Verify reason includes policy reference
-                if "clause" not in validated_result["reason"].lower():
-                    validated_result["reason"] += " (Based on policy analysis)"
+                validated_result = validate_analysis(
+                    parse_analysis_response(response.text),
+                    invoice_filename
+                )
                 
-                logger.info(f"Successfully analyzed {invoice_filename}")
+                logger.debug("Successfully analyzed %s", invoice_filename)
+                await cache_analysis(policy_text, invoice_text, validated_result)
                 return validated_result
                 
             except (json.JSONDecodeError, ValueError) as e:
@@ -111,9 +430,11 @@ async def analyze_invoice_with_gemini(policy_text: str, invoice_text: str, invoi
                     }
                     
         except Exception as e:
-            if attempt < max_retries - 1:
-                logger.warning(f"Analysis attempt {attempt + 1} failed: {str(e)}")
-                await asyncio.sleep(retry_delay)
+            if attempt < max_retries - 1 and not isinstance(e, NON_RETRYABLE_ERRORS):
+                # Exponential backoff with full jitter so concurrent calls don't retry in lockstep
+                delay = random.uniform(0, min(MAX_RETRY_DELAY, retry_delay * 2 ** attempt))
+                logger.warning(f"Analysis attempt {attempt + 1} failed, retrying in {delay:.1f}s: {str(e)}")
+                await asyncio.sleep(delay)
             else:
                 raise
 
@@ -124,23 +445,203 @@ async def analyze_invoice_with_gemini(policy_text: str, invoice_text: str, invoi
         "reason": "Maximum analysis attempts exceeded"
     }
 
-async def process_zip_file(zip_content: bytes, max_files: int = None) -> List[Dict[str, Any]]:
+async def analyze_invoice_batch_with_gemini(
+    policy_text: str,
+    invoices: List[Dict[str, Any]],
+    policy_cache: Optional[caching.CachedContent] = None,
+    semaphore: Optional[asyncio.Semaphore] = None
+) -> List[Dict[str, Any]]:
+    """
+    Analyze several invoices against the policy in a single Gemini request
+    
+    The policy is sent (or read from the context cache) once for the whole
+    batch and Gemini returns a JSON array with one verdict per invoice, each
+    naming its invoice filename. Invoices whose verdict is missing, invalid or
+    names the wrong file, or all of them if the batch request fails, fall back
+    to analyze_invoice_with_gemini.
+    
+    Args:
+        policy_text: Extracted policy text
+        invoices: Dicts with "filename" and "text" keys
+        policy_cache: Optional Gemini context cache holding the policy prefix
+        semaphore: Optional limit on concurrent Gemini calls, taken per call
+        
+    Returns:
+        One analysis result per invoice, in input order
+    """
+    results: List[Optional[Dict[str, Any]]] = [None] * len(invoices)
+    pending = []
+    
+    cached_results = await get_cached_analyses(policy_text, [invoice['text'] for invoice in invoices])
+    for index, (invoice, cached_result) in enumerate(zip(invoices, cached_results)):
+        if cached_result is not None:
+            logger.debug("Using cached analysis for %s", invoice['filename'])
+            results[index] = {**cached_result, "invoice_id": invoice['filename']}
+        else:
+            pending.append(index)
+    
+    if len(pending) > 1:
+        policy_prefix, suffix = build_policy_prefix(policy_text)
+        invoice_section = "\n\n".join(
+            f"### INVOICE {number}: {invoices[index]['filename']}\n{invoices[index]['text']}"
+            for number, index in enumerate(pending, start=1)
+        )
+        batch_suffix = suffix + BATCH_INSTRUCTION.format(count=len(pending))
+        
+        try:
+            model = get_model(policy_cache)
+            if policy_cache is not None:
+                formatted_prompt = ''.join((invoice_section, batch_suffix))
+            else:
+                formatted_prompt = ''.join((policy_prefix, invoice_section, batch_suffix))
+            
+            response = await generate_content(model, formatted_prompt, semaphore)
+            verdicts = parse_analysis_response(response.text)
+            
+            if not isinstance(verdicts, list):
+                raise ValueError(f"Expected a JSON array of {len(pending)} verdicts")
+            
+            # Match verdicts to invoices by the filename they name, never by
+            # position, so a reordered or shifted array cannot swap verdicts
+            unmatched = {invoices[index]['filename']: index for index in pending}
+            
+            validated_texts, validated_results = [], []
+            for verdict in verdicts:
+                if not isinstance(verdict, dict):
+                    continue
+                index = unmatched.pop(str(verdict.get("invoice", "")).strip(), None)
+                if index is None:
+                    logger.warning(f"Batch verdict names an unknown or repeated invoice: {verdict.get('invoice')!r}")
+                    continue
+                
+                invoice = invoices[index]
+                try:
+                    validated_result = validate_analysis(verdict, invoice['filename'])
+                except (AttributeError, TypeError, ValueError) as e:
+                    logger.warning(f"Invalid batch verdict for {invoice['filename']}: {str(e)}")
+                    continue
+                
+                validated_texts.append(invoice['text'])
+                validated_results.append(validated_result)
+                results[index] = validated_result
+            
+            # Embed the whole batch at once for the semantic cache
+            await cache_analyses(policy_text, validated_texts, validated_results)
+            
+            logger.debug("Batch analyzed %d/%d invoices", sum(results[i] is not None for i in pending), len(pending))
+            
+        except Exception as e:
+            logger.warning(f"Batch analysis failed, analyzing invoices individually: {str(e)}")
+    
+    # Anything the batch could not settle is analyzed on its own, concurrently;
+    # a failure only affects its own invoice
+    unsettled = [index for index in pending if results[index] is None]
+    fallback_results = await asyncio.gather(*(
+        analyze_invoice_with_gemini(
+            policy_text=policy_text,
+            invoice_text=invoices[index]['text'],
+            invoice_filename=invoices[index]['filename'],
+            policy_cache=policy_cache,
+            semaphore=semaphore
+        )
+        for index in unsettled
+    ), return_exceptions=True)
+    for index, result in zip(unsettled, fallback_results):
+        if isinstance(result, Exception):
+            logger.error(f"Analysis failed for {invoices[index]['filename']}: {str(result)}")
+            result = {
+                "invoice_id": invoices[index]['filename'],
+                "reimbursement_status": "Declined",
+                "reimbursable_amount": 0,
+                "reason": f"Analysis failed: {str(result)}"
+            }
+        results[index] = result
+    
+    return results
+
+async def run_in_pdf_pool(func, *args):
+    """
+    Run func(*args) in the PDF worker pool, recovering if the pool broke
+    
+    A worker that dies (a MuPDF crash on a malformed PDF, an OOM kill) leaves
+    the ProcessPoolExecutor permanently unusable and fails every call that was
+    queued on it. The shared pool is replaced for later calls, and each failed
+    call is retried once in its own single-use process, so the input that
+    killed the worker can only fail itself.
+    """
+    global _pdf_pool
+    loop = asyncio.get_running_loop()
+    pool = _pdf_pool
+    
+    try:
+        return await loop.run_in_executor(pool, func, *args)
+    except BrokenProcessPool:
+        # Several calls can fail on the same broken pool; only the first replaces it
+        if _pdf_pool is pool:
+            logger.error("PDF worker pool broke (a worker process died), restarting it")
+            pool.shutdown(wait=False, cancel_futures=True)
+            _pdf_pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+    
+    async with _isolated_retry_slots:
+        isolated_pool = ProcessPoolExecutor(max_workers=1)
+        try:
+            return await loop.run_in_executor(isolated_pool, func, *args)
+        finally:
+            isolated_pool.shutdown(wait=False)
+
+async def extract_pdf_text(pdf_content: bytes) -> str:
+    """
+    Extract PDF text in the worker pool, splitting large PDFs by page range
+    
+    PyMuPDF is not thread-safe, so pages are parallelized across processes:
+    each worker opens its own copy of the document and extracts one range.
+    """
+    if len(pdf_content) >= PDF_SPLIT_MIN_BYTES:
+        page_count = await run_in_pdf_pool(get_pdf_page_count, pdf_content)
+        if page_count > PDF_PAGES_PER_TASK:
+            parts = await asyncio.gather(*[
+                run_in_pdf_pool(
+                    extract_text_from_pdf, pdf_content,
+                    first_page, min(first_page + PDF_PAGES_PER_TASK, page_count)
+                )
+                for first_page in range(0, page_count, PDF_PAGES_PER_TASK)
+            ])
+            # Same blank-line page separation as a single-range extraction
+            return "\n\n".join(part for part in parts if part)
+    
+    return await run_in_pdf_pool(extract_text_from_pdf, pdf_content)
+
+async def process_zip_file(zip_file: BinaryIO, max_files: int = None) -> List[Dict[str, Any]]:
     """
     Extract and process all PDF files from a zip archive
     
+    Entries are read one at a time from the seekable file object and handed
+    to the extraction pool as soon as they are read, so extraction overlaps
+    with decompressing the remaining entries and each PDF's bytes are
+    released once its extraction finishes. Byte-identical PDFs are extracted once; the
+    extra copies are listed under "duplicates" as (position, filename) pairs.
+    "position" is each file's index in ZIP order, so callers can restore it.
+    
     Args:
-        zip_content: Bytes content of the ZIP file
+        zip_file: Seekable binary file object containing the ZIP archive
         max_files: Optional maximum number of files to process (None = process all)
     """
     pdf_files = []
+    filenames = []
+    positions = []
+    extractions = []
+    # Content digest -> (position, filename) of later byte-identical copies
+    duplicates: Dict[bytes, List[Tuple[int, str]]] = {}
+    digests = []
     
     try:
-        with zipfile.ZipFile(io.BytesIO(zip_content), 'r') as zip_ref:
+        with zipfile.ZipFile(zip_file, 'r') as zip_ref:
             # Get all PDF files
             all_pdf_files = [
-                f for f in zip_ref.filelist 
-                if f.filename.lower().endswith('.pdf') and 
-                not f.filename.startswith('__MACOSX')
+                f for f in zip_ref.infolist()
+                if not f.is_dir() and
+                not f.filename.startswith('__MACOSX') and
+                f.filename.lower().endswith('.pdf')
             ]
             
             logger.info(f"Found {len(all_pdf_files)} PDF files in ZIP")
@@ -153,16 +654,27 @@ async def process_zip_file(zip_content: bytes, max_files: int = None) -> List[Di
             if max_files:
                 files_to_process = files_to_process[:max_files]
                 
-            # Process files
-            for file_info in files_to_process:
+            # Dispatch each entry to the extraction pool as soon as it is read
+            for position, file_info in enumerate(files_to_process):
                 try:
-                    pdf_content = zip_ref.read(file_info.filename)
-                    pdf_text = extract_text_from_pdf(pdf_content)
-                    pdf_files.append({
-                        "filename": file_info.filename,
-                        "text": pdf_text
-                    })
-                    logger.info(f"Extracted text from PDF: {file_info.filename}")
+                    # Passing the ZipInfo skips the by-name lookup in the central directory
+                    pdf_content = zip_ref.read(file_info)
+                    
+                    # Identical files are extracted and analyzed once
+                    digest = hashlib.blake2b(pdf_content, digest_size=16).digest()
+                    if digest in duplicates:
+                        duplicates[digest].append((position, file_info.filename))
+                        logger.debug("Skipping duplicate PDF: %s", file_info.filename)
+                        continue
+                    duplicates[digest] = []
+                    
+                    extractions.append(asyncio.create_task(extract_pdf_text(pdf_content)))
+                    filenames.append(file_info.filename)
+                    positions.append(position)
+                    digests.append(digest)
+                    
+                    # Let the task run up to its pool submit before reading the next entry
+                    await asyncio.sleep(0)
                 except Exception as file_error:
                     logger.error(f"Error processing PDF {file_info.filename}: {str(file_error)}")
                     continue
@@ -171,8 +683,43 @@ async def process_zip_file(zip_content: bytes, max_files: int = None) -> List[Di
         logger.error(f"Error processing zip file: {str(e)}")
         raise HTTPException(status_code=400, detail=f"Error processing zip file: {str(e)}")
     
+    # PDF parsing is CPU-bound; it runs in worker processes so the event loop stays free
+    texts = await asyncio.gather(*extractions, return_exceptions=True)
+    
+    for filename, position, digest, pdf_text in zip(filenames, positions, digests, texts):
+        if isinstance(pdf_text, Exception):
+            logger.error(f"Error processing PDF {filename}: {str(pdf_text)}")
+            continue
+        pdf_files.append({
+            "filename": filename,
+            "position": position,
+            "text": pdf_text,
+            "duplicates": duplicates[digest]
+        })
+        logger.debug("Extracted text from PDF: %s", filename)
+    
     return pdf_files
 
+async def validate_upload(upload: UploadFile, max_size: int, label: str) -> None:
+    """
+    Reject oversized uploads and anything that is not a ZIP container
+    
+    Only the first few bytes are read; the file is rewound afterwards.
+    
+    Raises:
+        HTTPException: 413 if the upload is too large, 415 on a wrong signature
+    """
+    if upload.size is not None and upload.size > max_size:
+        raise HTTPException(
+            status_code=413,
+            detail=f"{label} exceeds the maximum size of {max_size // (1024 * 1024)} MB"
+        )
+    
+    magic = await upload.read(len(ZIP_MAGIC))
+    await upload.seek(0)
+    if magic != ZIP_MAGIC:
+        raise HTTPException(status_code=415, detail=f"{label} content does not match its file type")
+
 @app.post("/analyze-invoices")
 async def analyze_invoices(
     policy_file: UploadFile = File(...),
@@ -188,59 +735,124 @@ async def analyze_invoices(
     if not invoice_zip.filename.lower().endswith('.zip'):
         raise HTTPException(status_code=400, detail="Invoice file must be a .zip file")
     
+    # Check signatures and sizes before any parsing work
+    await validate_upload(policy_file, MAX_POLICY_FILE_SIZE, "Policy file")
+    await validate_upload(invoice_zip, MAX_INVOICE_ZIP_SIZE, "Invoice file")
+    
+    started = time.perf_counter()
+    
     try:
         # Read and extract policy text
         logger.info(f"Processing policy file: {policy_file.filename}")
-        policy_content = await policy_file.read()
-        policy_text = extract_text_from_docx(policy_content)
+        # Validate and extract in one parse, straight from the spooled upload
+        is_valid_policy, policy_text = parse_document(policy_file.file, 'docx')
+        
+        if not is_valid_policy:
+            raise HTTPException(status_code=400, detail="Policy file is not a valid .docx document")
         
         if not policy_text.strip():
             raise HTTPException(status_code=400, detail="Policy document appears to be empty")
         
-        # Read and process zip file
+        policy_text = await compress_policy(policy_text)
+        policy_text = truncate_text(policy_text, MAX_POLICY_CHARS, "Policy text")
+        
+        # Cache the policy prefix once so each invoice only sends its own text
+        policy_prefix, _ = build_policy_prefix(policy_text)
+        policy_cache = await asyncio.to_thread(get_policy_cache, policy_prefix)
+        
+        # Process the zip file straight from the spooled upload
         logger.info(f"Processing invoice zip file: {invoice_zip.filename}")
-        zip_content = await invoice_zip.read()
-        pdf_files = await process_zip_file(zip_content, max_files=None)
+        pdf_files = await process_zip_file(invoice_zip.file, max_files=None)
         
         if not pdf_files:
             raise HTTPException(status_code=400, detail="No PDF files found in the zip archive")
         
-        # Analyze each invoice
-        analysis_results = []
-        for pdf_file in pdf_files:
-            logger.info(f"Analyzing invoice: {pdf_file['filename']}")
-            
+        # Analyze invoices in batches, concurrently; the semaphore bounds the
+        # number of Gemini calls in flight to respect rate limits
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_ANALYSES)
+        analysis_results: List[Optional[Dict[str, Any]]] = [None] * len(pdf_files)
+        analyzable = []
+        
+        for index, pdf_file in enumerate(pdf_files):
             if not pdf_file['text'].strip():
-                result = {
+                analysis_results[index] = {
                     "invoice_id": pdf_file['filename'],
                     "reimbursement_status": "Declined",
                     "reimbursable_amount": 0,
                     "reason": "Could not extract text from PDF"
                 }
             else:
-                result = await analyze_invoice_with_gemini(
-                    policy_text=policy_text,
-                    invoice_text=pdf_file['text'],
-                    invoice_filename=pdf_file['filename']
+                pdf_file['text'] = truncate_text(
+                    pdf_file['text'], MAX_INVOICE_CHARS, f"Invoice text of {pdf_file['filename']}"
                 )
+                analyzable.append(index)
+        
+        batches = [
+            analyzable[i:i + ANALYSIS_BATCH_SIZE]
+            for i in range(0, len(analyzable), ANALYSIS_BATCH_SIZE)
+        ]
+        
+        async def analyze_batch(batch: List[int]) -> List[Dict[str, Any]]:
+            logger.debug("Analyzing batch of %d invoices starting with %s", len(batch), pdf_files[batch[0]]['filename'])
             
-            analysis_results.append(result)
+            return await analyze_invoice_batch_with_gemini(
+                policy_text=policy_text,
+                invoices=[pdf_files[i] for i in batch],
+                policy_cache=policy_cache,
+                semaphore=semaphore
+            )
+        
+        # gather preserves input order, so results line up with batches
+        batch_results = await asyncio.gather(
+            *[analyze_batch(batch) for batch in batches],
+            return_exceptions=True
+        )
+        
+        for batch, results in zip(batches, batch_results):
+            for position, index in enumerate(batch):
+                if isinstance(results, Exception):
+                    logger.error(f"Analysis failed for {pdf_files[index]['filename']}: {str(results)}")
+                    analysis_results[index] = {
+                        "invoice_id": pdf_files[index]['filename'],
+                        "reimbursement_status": "Declined",
+                        "reimbursable_amount": 0,
+                        "reason": f"Analysis failed: {str(results)}"
+                    }
+                else:
+                    analysis_results[index] = results[position]
+        
+        # Duplicate PDFs share the verdict of the copy that was analyzed;
+        # results are returned in the order of the entries in the ZIP
+        positioned_results = []
+        for pdf_file, result in zip(pdf_files, analysis_results):
+            positioned_results.append((pdf_file['position'], result))
+            positioned_results.extend(
+                (position, {**result, "invoice_id": duplicate})
+                for position, duplicate in pdf_file['duplicates']
+            )
+        positioned_results.sort(key=lambda item: item[0])
+        analysis_results = [result for _, result in positioned_results]
+        
+        logger.info(
+            f"Analyzed {len(analysis_results)} invoices "
+            f"({len(analysis_results) - len(pdf_files)} duplicates) in {time.perf_counter() - started:.2f}s"
+        )
         
         # Return simplified response matching expected format
         response_data = {
             "analysis": analysis_results
         }
         
-        return JSONResponse(content=response_data)
+        return ORJSONResponse(content=response_data)
         
+    except HTTPException:
+        # Client errors raised above (invalid or empty uploads) keep their status
+        raise
     except Exception as e:
         logger.error(f"Analysis failed: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/", response_class=HTMLResponse)
-async def root():
-    """Root endpoint with basic information"""
-    return """
+_ROOT_RESPONSE = HTMLResponse(content="""
     <html>
         <head>
             <title>Invoice Reimbursement Analysis API</title>
@@ -254,12 +866,35 @@ async def root():
             </ul>
         </body>
     </html>
-    """
+    """)
 
-@app.get("/upload-form", response_class=HTMLResponse)
-async def upload_form():
-    """Simple HTML form for file upload with modern design"""
-    return """
+@app.get("/", response_class=HTMLResponse)
+async def root():
+    """Root endpoint with basic information"""
+    return _ROOT_RESPONSE
+
+_HEALTH_RESPONSE = Response(content=orjson.dumps({"status": "healthy"}), media_type="application/json")
+
+@app.get("/health")
+async def health_check():
+    """Liveness check that does not touch the Gemini API"""
+    return _HEALTH_RESPONSE
+
+@app.get("/health/deep")
+async def deep_health_check():
+    """Readiness check that runs a real Gemini generation request"""
+    try:
+        await _model.generate_content_async("Test connection")
+    except Exception as e:
+        logger.error(f"Gemini health check failed: {str(e)}")
+        return ORJSONResponse(
+            status_code=503,
+            content={"status": "unhealthy", "gemini": "unreachable", "detail": str(e)}
+        )
+    
+    return {"status": "healthy", "gemini": "reachable"}
+
+_UPLOAD_FORM_RESPONSE = HTMLResponse(content="""
     <html>
         <head>
             <title>Upload Files for Analysis</title>
@@ -357,7 +992,12 @@ async def upload_form():
             </div>
         </body>
     </html>
-    """
+    """)
+
+@app.get("/upload-form", response_class=HTMLResponse)
+async def upload_form():
+    """Simple HTML form for file upload with modern design"""
+    return _UPLOAD_FORM_RESPONSE
 
 if __name__ == "__main__":
     import uvicorn
@@ -367,5 +1007,7 @@ if __name__ == "__main__":
         host="127.0.0.1",  # Changed from 0.0.0.0 to localhost
         port=8000,
         reload=True,
+        # loop/http default to "auto", which picks uvloop and httptools from
+        # uvicorn[standard] where they are available (not uvloop on Windows)
         log_level="info"
     )
\ No newline at end of file
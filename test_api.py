@@ -1,56 +1,106 @@
 import google.generativeai as genai
 from dotenv import load_dotenv
+from google.api_core import exceptions as google_exceptions
+from tenacity import AsyncRetrying, before_sleep_log, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+from functools import lru_cache
+from typing import List, Optional
+import asyncio
+import logging
 import os
-import time
+import sys
 
-def test_gemini_api():
+logger = logging.getLogger(__name__)
+
+MAX_RETRIES = 3
+MAX_CONCURRENT = 8
+
+# Only rate limiting and temporary unavailability are worth retrying; auth and
+# request errors (e.g. API_KEY_INVALID) fail immediately
+RETRYABLE_ERRORS = (google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable)
+
+@lru_cache(maxsize=1)
+def _get_model() -> genai.GenerativeModel:
+    """
+    Configure the client and build the model once per process
+    
+    The default transports are gRPC (grpc_asyncio for async calls), so every
+    request reuses one multiplexed HTTP/2 channel. Passing transport='grpc'
+    explicitly would also be applied to the async client and break it.
+    """
+    genai.configure(api_key=os.environ["GEMINI_API_KEY"])
+    return genai.GenerativeModel('gemini-1.5-flash')
+
+async def call_gemini(model: genai.GenerativeModel, prompt: str) -> str:
+    """Send one prompt to Gemini with retries and return the response text"""
+    async for attempt in AsyncRetrying(
+        stop=stop_after_attempt(MAX_RETRIES),
+        wait=wait_random_exponential(multiplier=1, max=30),
+        retry=retry_if_exception_type(RETRYABLE_ERRORS),
+        before_sleep=before_sleep_log(logger, logging.WARNING),
+        reraise=True
+    ):
+        with attempt:
+            response = await model.generate_content_async(prompt)
+    return response.text
+
+async def batch_generate(model: genai.GenerativeModel, prompts: List[str], max_concurrent: int = MAX_CONCURRENT) -> List[str]:
+    """Send prompts concurrently, at most max_concurrent in flight, preserving order"""
+    semaphore = asyncio.Semaphore(max_concurrent)
+
+    async def one(prompt: str) -> str:
+        async with semaphore:
+            return await call_gemini(model, prompt)
+
+    return await asyncio.gather(*(one(prompt) for prompt in prompts))
+
+def load_invoice_prompts(invoice_dir: str) -> List[str]:
+    """Build one prompt per PDF in invoice_dir"""
+    from utils import extract_text_from_pdf
+
+    prompts = []
+    for filename in sorted(os.listdir(invoice_dir)):
+        if filename.lower().endswith('.pdf'):
+            invoice_text = extract_text_from_pdf(os.path.join(invoice_dir, filename))
+            prompts.append(f"Summarize the vendor, date and total of this invoice:\n{invoice_text}")
+    return prompts
+
+def test_gemini_api(invoice_dir: Optional[str] = None):
     # Load environment variables
     load_dotenv()
-    
+    logging.basicConfig(level=logging.INFO)
+
     # Debug: Print current working directory
     print(f"Current directory: {os.getcwd()}")
-    
+
     # Get API key
     api_key = os.getenv("GEMINI_API_KEY")
     if not api_key:
         print("❌ Error: GEMINI_API_KEY not found in .env file")
         return
-    
+
     print("🔑 API key loaded")
-    
+
     try:
-        # Configure Gemini
-        genai.configure(api_key=api_key)
-        
-        # Test the API with retry logic
-        max_retries = 3
-        retry_delay = 2
-        
-        for attempt in range(max_retries):
-            try:
-                print(f"📝 Testing API (attempt {attempt + 1}/{max_retries})...")
-                model = genai.GenerativeModel('gemini-1.5-flash')
-                response = model.generate_content("Say 'API is working!'")
-                
-                print("✅ API test successful!")
-                print(f"Response: {response.text}")
-                return
-                
-            except Exception as retry_error:
-                if "API_KEY_INVALID" in str(retry_error):
-                    print("❌ API key is invalid or expired")
-                    print("Please generate a new key at: https://makersuite.google.com/app/apikey")
-                    return
-                    
-                if attempt < max_retries - 1:
-                    print(f"⚠️ Attempt failed, retrying in {retry_delay} seconds...")
-                    time.sleep(retry_delay)
-                else:
-                    raise
-                    
+        # Configure Gemini once and share the model across all prompts
+        model = _get_model()
+
+        prompts = load_invoice_prompts(invoice_dir) if invoice_dir else ["Say 'API is working!'"]
+        print(f"📝 Testing API with {len(prompts)} prompt(s), up to {MAX_CONCURRENT} at a time...")
+        responses = asyncio.run(batch_generate(model, prompts))
+
+        print("✅ API test successful!")
+        for response_text in responses:
+            print(f"Response: {response_text}")
+
     except Exception as e:
+        if "API_KEY_INVALID" in str(e):
+            print("❌ API key is invalid or expired")
+            print("Please generate a new key at: https://makersuite.google.com/app/apikey")
+            return
+
         print("❌ API test failed!")
         print(f"Error: {str(e)}")
 
 if __name__ == "__main__":
-    test_gemini_api()
\ No newline at end of file
+    # Optionally pass a folder of invoice PDFs to send them as a concurrent batch
+    test_gemini_api(sys.argv[1] if len(sys.argv) > 1 else None)
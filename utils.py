@@ -1,94 +1,351 @@
+import ahocorasick
+import diskcache
 import docx
-import pdfplumber
+import fitz  # PyMuPDF
+import hashlib
+import inspect
 import io
 import os
 import logging
+import tempfile
+import threading
+from cachetools import LRUCache
+from functools import lru_cache, wraps
+from lxml import etree
+from typing import Any, BinaryIO, Callable, Optional, Tuple, Union
 
 logger = logging.getLogger(__name__)
 
-def extract_text_from_docx(docx_content: bytes) -> str:
+# Inputs accepted by the extractors: raw bytes, a seekable binary file object
+# (e.g. a spooled upload) or a filesystem path, so callers need not load whole
+# files into memory first
+DocumentSource = Union[bytes, BinaryIO, str, os.PathLike]
+
+# Extracted text keyed by file content hash, so re-submitted invoices and
+# policies skip parsing. Hot entries are kept in process memory; all entries
+# persist on disk, shared by the PDF worker processes and across restarts.
+EXTRACT_CACHE_DIR = os.getenv("EXTRACT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "invoice_extract"))
+EXTRACT_CACHE_SIZE_LIMIT = 2 ** 30  # bytes
+# Persisted invoice text is removed after this long rather than lingering in
+# the shared temp directory until the size limit forces eviction
+EXTRACT_CACHE_TTL = 24 * 3600  # seconds
+# Bump when extraction output changes so stale persisted text is not served
+EXTRACT_CACHE_VERSION = 4
+_extract_disk_cache = diskcache.Cache(EXTRACT_CACHE_DIR, size_limit=EXTRACT_CACHE_SIZE_LIMIT)
+_extract_memory_cache: LRUCache = LRUCache(maxsize=128)
+_extract_memory_lock = threading.Lock()
+
+# Compiled XPath queries for DOCX table text. Reading the XML directly skips
+# python-docx's per-cell objects and its merged-cell grid, which repeats the
+# text of a merged cell once for every grid column or row it spans.
+_W_NS = {'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'}
+_TABLE_ROWS = etree.XPath('./w:tr', namespaces=_W_NS)
+_ROW_CELLS = etree.XPath('./w:tc', namespaces=_W_NS)
+# Yields python-docx CT_P elements; their .text renders tabs and breaks as
+# "\t" and "\n" exactly like Paragraph.text, and skips nested text boxes
+_CELL_PARAGRAPHS = etree.XPath('./w:p', namespaces=_W_NS)
+
+# Keyword categories used by extract_key_info_from_invoice; substring matches
+# against the lowercased text, as "date" also covers "dated" and "invoice date"
+KEY_INFO_KEYWORDS = {
+    "date": ("date",),
+    "amount": ("$", "₹", "rs", "amount", "total"),
+    "vendor": ("vendor", "company", "ltd", "inc", "pvt"),
+}
+
+def _build_key_info_automaton() -> ahocorasick.Automaton:
+    """Build one Aho-Corasick automaton mapping every keyword to its category"""
+    automaton = ahocorasick.Automaton()
+    for category, keywords in KEY_INFO_KEYWORDS.items():
+        for keyword in keywords:
+            automaton.add_word(keyword, category)
+    automaton.make_automaton()
+    return automaton
+
+_KEY_INFO_AUTOMATON = _build_key_info_automaton()
+
+# MuPDF text extraction flags: the "blocks" defaults without
+# TEXT_PRESERVE_IMAGES, so MuPDF does not build image blocks we would discard
+PDF_TEXT_FLAGS = fitz.TEXT_PRESERVE_LIGATURES | fitz.TEXT_PRESERVE_WHITESPACE | fitz.TEXT_MEDIABOX_CLIP
+
+# Fallback prompt used when prompt.txt is missing. The stable instructions and
+# policy come first and the invoice last, so requests against the same policy
+# share the longest possible cacheable prefix.
+FALLBACK_SYSTEM_PROMPT = """You are an expert HR and finance analyst responsible for verifying reimbursement invoices based on a company's official policy document.
+
+Input:
+1. A company reimbursement policy (detailed below).
+2. An employee invoice (detailed below).
+
+Your task:
+- Carefully compare the invoice contents (date, items, amount, purpose, tax, category) against the company's reimbursement policy.
+- Determine whether the invoice should be Fully Reimbursed, Partially Reimbursed, or Declined.
+- Explain the decision with specific references to policy rules and amounts.
+
+Guidelines:
+- If all items in the invoice are within policy rules and limits, mark as "Fully Reimbursed".
+- If some items or amounts exceed policy limits but are otherwise valid, mark as "Partially Reimbursed" and give reimbursable amount.
+- If the invoice contains non-reimbursable or restricted items, mark as "Declined" and give the reason.
+- Reimbursable amount should always be an integer.
+- Only use the rules from the provided policy. Do not assume anything not mentioned.
+
+Format your response as JSON:
+{{
+  "invoice": "<invoice_filename>",
+  "status": "Fully Reimbursed | Partially Reimbursed | Declined",
+  "amount": <reimbursable_integer>,
+  "reason": "<short explanation of decision>"
+}}"""
+
+FALLBACK_POLICY_BLOCK = """
+
+--- POLICY DOCUMENT ---
+{policy_text}"""
+
+FALLBACK_INVOICE_BLOCK = """
+
+--- INVOICE DOCUMENT ---
+{invoice_text}"""
+
+def _content_digest(content: DocumentSource) -> str:
+    """SHA-256 of a DocumentSource, leaving file objects at their original position"""
+    if isinstance(content, (bytes, bytearray)):
+        return hashlib.sha256(content).hexdigest()
+    
+    digest = hashlib.sha256()
+    if isinstance(content, (str, os.PathLike)):
+        with open(content, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+    else:
+        position = content.tell()
+        for chunk in iter(lambda: content.read(1 << 20), b''):
+            digest.update(chunk)
+        content.seek(position)
+    return digest.hexdigest()
+
+def _cache_extraction(extract: Callable[..., str]) -> Callable[..., str]:
+    """
+    Cache an extractor's output by content hash and arguments
+    
+    Empty results are not cached, as extractors also return "" on errors.
+    """
+    signature = inspect.signature(extract)
+    
+    @wraps(extract)
+    def wrapper(content: DocumentSource, *args: Any, **kwargs: Any) -> str:
+        # Bind with defaults so f(x), f(x, 0, None) and f(x, first_page=0) share a key
+        bound = signature.bind(content, *args, **kwargs)
+        bound.apply_defaults()
+        options = list(bound.arguments.items())[1:]
+        try:
+            key = f"v{EXTRACT_CACHE_VERSION}:{extract.__name__}:{_content_digest(content)}:{options}"
+        except OSError as e:
+            logger.error(f"Could not hash {extract.__name__} input: {str(e)}")
+            return extract(content, *args, **kwargs)
+        
+        with _extract_memory_lock:
+            text = _extract_memory_cache.get(key)
+        if text is not None:
+            return text
+        
+        text = _extract_disk_cache.get(key)
+        if text is None:
+            text = extract(content, *args, **kwargs)
+            if not text:
+                return text
+            _extract_disk_cache.set(key, text, expire=EXTRACT_CACHE_TTL)
+        
+        with _extract_memory_lock:
+            _extract_memory_cache[key] = text
+        return text
+    
+    return wrapper
+
+def extract_text_from_docx(docx_content: DocumentSource) -> str:
     """
     Extract text from a DOCX file with enhanced structure preservation
     
     Args:
-        docx_content: Bytes content of the DOCX file
+        docx_content: DOCX file as bytes, binary file object or path
         
     Returns:
-        Extracted text as string with preserved formatting
+        Extracted text as string with preserved formatting, or "" on error
     """
     try:
-        # Create a file-like object from bytes
-        docx_stream = io.BytesIO(docx_content)
-        
-        # Load the document
-        doc = docx.Document(docx_stream)
-        
-        # Extract text from all paragraphs with structure
-        text_content = []
-        
-        # Process paragraphs
-        for paragraph in doc.paragraphs:
-            if paragraph.text.strip():
-                # Check if paragraph looks like a heading
-                if paragraph.style.name.startswith('Heading') or len(paragraph.text) < 100:
-                    text_content.append(f"\n=== {paragraph.text.strip()} ===")
-                else:
-                    text_content.append(paragraph.text.strip())
-        
-        # Extract text from tables with better formatting
-        for table_num, table in enumerate(doc.tables):
-            text_content.append(f"\n--- TABLE {table_num + 1} ---")
-            for row_num, row in enumerate(table.rows):
-                row_text = []
-                for cell in row.cells:
-                    cell_text = cell.text.strip()
-                    if cell_text:
-                        row_text.append(cell_text)
-                
-                if row_text:
-                    if row_num == 0:  # Header row
-                        text_content.append("HEADERS: " + " | ".join(row_text))
-                    else:
-                        text_content.append(" | ".join(row_text))
-        
-        extracted_text = "\n".join(text_content)
-        
-        # Clean the text
-        cleaned_text = clean_text(extracted_text)
-        
-        logger.info(f"Extracted {len(cleaned_text)} characters from DOCX with {len(doc.paragraphs)} paragraphs and {len(doc.tables)} tables")
-        
-        return cleaned_text
-        
+        return _parse_docx(docx_content)
     except Exception as e:
         logger.error(f"Error extracting text from DOCX: {str(e)}")
         return ""
 
-def extract_text_from_pdf(pdf_content: bytes) -> str:
+@_cache_extraction
+def _parse_docx(docx_content: DocumentSource) -> str:
+    """Extract DOCX text, raising if the content is not a valid document"""
+    # Load the document; file objects and paths are read in place
+    doc = docx.Document(_as_docx_source(docx_content))
+    
+    # python-docx rebuilds these lists on every access, so fetch them once
+    paragraphs = doc.paragraphs
+    tables = doc.tables
+    
+    # Resolve heading styles once; paragraph.style would look the style up
+    # by id and build a style object for every paragraph
+    heading_style_ids = {
+        style.style_id for style in doc.styles
+        if style.name and style.name.startswith('Heading')
+    }
+    
+    # Extract text from all paragraphs with structure
+    text_content = []
+    append = text_content.append
+    
+    # Process paragraphs; paragraph.text re-walks the XML runs on every access
+    for paragraph in paragraphs:
+        paragraph_text = paragraph.text
+        stripped_text = paragraph_text.strip()
+        if not stripped_text:
+            continue
+    
+        # Check if paragraph looks like a heading
+        if len(paragraph_text) < 100 or _paragraph_style_id(paragraph) in heading_style_ids:
+            append(f"\n=== {stripped_text} ===")
+        else:
+            append(stripped_text)
+    
+    # Extract text from tables with better formatting
+    for table_num, table in enumerate(tables):
+        append(f"\n--- TABLE {table_num + 1} ---")
+        for row_num, row in enumerate(_TABLE_ROWS(table._tbl)):
+            row_text = []
+            for cell in _ROW_CELLS(row):
+                cell_text = "\n".join(
+                    paragraph.text for paragraph in _CELL_PARAGRAPHS(cell)
+                ).strip()
+                if cell_text:
+                    row_text.append(cell_text)
+    
+            if row_text:
+                if row_num == 0:  # Header row
+                    append("HEADERS: " + " | ".join(row_text))
+                else:
+                    append(" | ".join(row_text))
+    
+    extracted_text = "\n".join(text_content)
+    
+    # Clean the text
+    cleaned_text = clean_text(extracted_text)
+    
+    logger.info(f"Extracted {len(cleaned_text)} characters from DOCX with {len(paragraphs)} paragraphs and {len(tables)} tables")
+    
+    return cleaned_text
+
+def _paragraph_style_id(paragraph: Any) -> Optional[str]:
+    """Return the raw pStyle id of a paragraph, or None if it uses the default style"""
+    pPr = paragraph._p.pPr
+    if pPr is None or pPr.pStyle is None:
+        return None
+    return pPr.pStyle.val
+
+def _as_docx_source(content: DocumentSource) -> Union[BinaryIO, str]:
+    """Adapt a DocumentSource to what docx.Document accepts"""
+    if isinstance(content, (bytes, bytearray)):
+        return io.BytesIO(content)
+    if isinstance(content, os.PathLike):
+        return os.fspath(content)
+    return content
+
+def _open_pdf(content: DocumentSource) -> fitz.Document:
+    """Open a DocumentSource as a PyMuPDF document"""
+    if isinstance(content, (str, os.PathLike)):
+        # MuPDF reads the file itself, no copy in Python memory
+        return fitz.open(os.fspath(content), filetype="pdf")
+    if not isinstance(content, (bytes, bytearray)):
+        content = content.read()
+    return fitz.open(stream=content, filetype="pdf")
+
+def get_pdf_page_count(pdf_content: DocumentSource) -> int:
+    """
+    Return the number of pages in a PDF, or 0 if it cannot be opened
+    
+    Args:
+        pdf_content: PDF file as bytes, binary file object or path
+    """
+    try:
+        with _open_pdf(pdf_content) as pdf_document:
+            return pdf_document.page_count
+    except Exception as e:
+        logger.error(f"Error reading PDF page count: {str(e)}")
+        return 0
+
+def extract_text_from_pdf(pdf_content: DocumentSource, first_page: int = 0, last_page: Optional[int] = None) -> str:
     """
-    Extract text from PDF content using pdfplumber
+    Extract text from PDF content using PyMuPDF
+    
+    Pages that reference no fonts cannot contain text (typically scanned,
+    raster-only receipts), so they are skipped without parsing their content
+    streams. Other pages are read as text blocks sorted top-to-bottom, which
+    keeps receipt columns and totals in reading order in a single pass.
     
     Args:
-        pdf_content: Bytes content of the PDF file
+        pdf_content: PDF file as bytes, binary file object or path
+        first_page: Index of the first page to extract
+        last_page: Index after the last page to extract (None = to the end),
+            so large PDFs can be split across worker processes
         
     Returns:
-        Extracted text as string with preserved structure
+        Extracted text as string with preserved structure, or "" on error
     """
     try:
-        text = ""
-        with pdfplumber.open(io.BytesIO(pdf_content)) as pdf:
-            for page in pdf.pages:
-                text += page.extract_text() or ""
-        
-        if not text.strip():
-            logger.warning("No text extracted from PDF - may be scanned/image-based")
-            return ""
-            
-        return text.strip()
+        return _parse_pdf(pdf_content, first_page, last_page)
     except Exception as e:
         logger.error(f"Error extracting text from PDF: {str(e)}")
         return ""
 
+@_cache_extraction
+def _parse_pdf(pdf_content: DocumentSource, first_page: int = 0, last_page: Optional[int] = None) -> str:
+    """Extract PDF text, raising if the content is not a valid PDF"""
+    # Block texts of all pages go into one flat list joined once at the
+    # end, instead of building an intermediate string per page
+    text_parts = []
+    append = text_parts.append
+    extend = text_parts.extend
+    page_count = 0
+    text_page_count = 0
+    image_only_pages = 0
+    
+    with _open_pdf(pdf_content) as pdf_document:
+        if pdf_document.page_count == 0:
+            raise ValueError("PDF has no pages")
+        for page in pdf_document.pages(first_page, last_page):
+            page_count += 1
+            if not page.get_fonts():
+                if page.get_images():
+                    image_only_pages += 1
+                continue
+            # Text blocks in reading order; image blocks (type 1) are dropped
+            blocks = page.get_text("blocks", flags=PDF_TEXT_FLAGS, sort=True)
+            if text_page_count:
+                append("\n")
+            text_page_count += 1
+            extend([block[4] for block in blocks if block[6] == 0])
+    
+    text = "".join(text_parts)
+    
+    if not text.strip():
+        if image_only_pages:
+            logger.warning(f"No text extracted from PDF - {image_only_pages} of {page_count} pages are image-only (scanned)")
+        else:
+            logger.warning("No text extracted from PDF - may be scanned/image-based")
+        return ""
+    
+    return text.strip()
+
+# Parsers used by parse_document, by file type
+_DOCUMENT_PARSERS = {
+    'docx': _parse_docx,
+    'pdf': _parse_pdf,
+}
+
 def load_prompt_template() -> str:
     """
     Load the prompt template from prompt.txt file
@@ -108,46 +365,68 @@ def load_prompt_template() -> str:
     except FileNotFoundError:
         logger.error("prompt.txt file not found")
         # Return a fallback template
-        return """You are an expert HR and finance analyst responsible for verifying reimbursement invoices based on a company's official policy document.
-
-Input:
-1. A company reimbursement policy (detailed below).
-2. An employee invoice (detailed below).
-
-Your task:
-- Carefully compare the invoice contents (date, items, amount, purpose, tax, category) against the company's reimbursement policy.
-- Determine whether the invoice should be Fully Reimbursed, Partially Reimbursed, or Declined.
-- Explain the decision with specific references to policy rules and amounts.
-
-Guidelines:
-- If all items in the invoice are within policy rules and limits, mark as "Fully Reimbursed".
-- If some items or amounts exceed policy limits but are otherwise valid, mark as "Partially Reimbursed" and give reimbursable amount.
-- If the invoice contains non-reimbursable or restricted items, mark as "Declined" and give the reason.
-- Reimbursable amount should always be an integer.
-- Only use the rules from the provided policy. Do not assume anything not mentioned.
-
-Format your response as JSON:
-{{
-  "invoice": "<invoice_filename>",
-  "status": "Fully Reimbursed | Partially Reimbursed | Declined",
-  "amount": <reimbursable_integer>,
-  "reason": "<short explanation of decision>"
-}}
-
---- POLICY DOCUMENT ---
-{policy_text}
-
---- INVOICE DOCUMENT ---
-{invoice_text}"""
+        return FALLBACK_SYSTEM_PROMPT + FALLBACK_POLICY_BLOCK + FALLBACK_INVOICE_BLOCK
         
     except Exception as e:
         logger.error(f"Error loading prompt template: {str(e)}")
         raise
 
+@lru_cache(maxsize=1)
+def get_prompt_parts() -> Tuple[str, str, str]:
+    """
+    Load the prompt template once and split it around its placeholders
+    
+    Building a prompt then becomes a plain concatenation instead of running
+    str.format over the template (and the large policy text) for every invoice.
+    
+    Returns:
+        Tuple of (prefix, middle, suffix) such that the full prompt is
+        prefix + policy_text + middle + invoice_text + suffix
+        
+    Raises:
+        ValueError: If the template does not place the policy before the invoice
+    """
+    template = load_prompt_template()
+    policy_pos = template.find('{policy_text}')
+    invoice_pos = template.find('{invoice_text}')
+    if policy_pos == -1 or invoice_pos == -1 or invoice_pos < policy_pos:
+        # The invoice must be the last variable segment to keep the policy prefix cacheable
+        raise ValueError("Prompt template must contain {policy_text} followed by {invoice_text}")
+    
+    prefix, rest = template.split('{policy_text}', 1)
+    middle, suffix = rest.split('{invoice_text}', 1)
+    
+    # Undo str.format escaping of literal braces
+    return tuple(part.replace('{{', '{').replace('}}', '}') for part in (prefix, middle, suffix))
+
+def parse_document(content: DocumentSource, file_type: str) -> Tuple[bool, str]:
+    """
+    Validate and extract a document in a single parse
+    
+    Args:
+        content: File as bytes, binary file object or path
+        file_type: Expected file type ('docx' or 'pdf')
+        
+    Returns:
+        Tuple of (is_valid, extracted_text); text is "" for invalid files
+    """
+    parser = _DOCUMENT_PARSERS.get(file_type.lower())
+    if parser is None:
+        return False, ""
+    
+    try:
+        return True, parser(content)
+    except Exception as e:
+        logger.error(f"File validation failed for {file_type}: {str(e)}")
+        return False, ""
+
 def validate_file_content(content: bytes, file_type: str) -> bool:
     """
     Validate if the file content is valid for the specified type
     
+    Prefer parse_document when the text is needed too, so the file is only
+    parsed once.
+    
     Args:
         content: File content as bytes
         file_type: Expected file type ('docx' or 'pdf')
@@ -155,26 +434,7 @@ def validate_file_content(content: bytes, file_type: str) -> bool:
     Returns:
         True if valid, False otherwise
     """
-    try:
-        if file_type.lower() == 'docx':
-            # Try to open as DOCX
-            docx_stream = io.BytesIO(content)
-            doc = docx.Document(docx_stream)
-            return True
-            
-        elif file_type.lower() == 'pdf':
-            # Try to open as PDF
-            pdf_stream = io.BytesIO(content)
-            pdf_document = fitz.open(stream=pdf_stream, filetype="pdf")
-            is_valid = pdf_document.page_count > 0
-            pdf_document.close()
-            return is_valid
-            
-        return False
-        
-    except Exception as e:
-        logger.error(f"File validation failed for {file_type}: {str(e)}")
-        return False
+    return parse_document(content, file_type)[0]
 
 def clean_text(text: str) -> str:
     """
@@ -189,17 +449,28 @@ def clean_text(text: str) -> str:
     if not text:
         return ""
     
-    # Remove excessive whitespace
-    lines = [line.strip() for line in text.split('\n') if line.strip()]
-    
-    # Join lines with single newlines
-    cleaned_text = '\n'.join(lines)
+    # Strip each line once and drop blank ones; since no blank lines survive,
+    # the result never contains runs of newlines that need collapsing. map and
+    # filter keep the per-line loop in C rather than a Python generator.
+    return '\n'.join(filter(None, map(str.strip, text.splitlines())))
+
+def truncate_text(text: str, max_chars: int, label: str = "Text") -> str:
+    """
+    Cap text at max_chars characters to bound prompt size
     
-    # Remove multiple consecutive newlines
-    while '\n\n\n' in cleaned_text:
-        cleaned_text = cleaned_text.replace('\n\n\n', '\n\n')
+    Args:
+        text: Text to truncate
+        max_chars: Maximum number of characters to keep
+        label: Name used in the warning when text is cut
+        
+    Returns:
+        The original text, or its first max_chars characters
+    """
+    if len(text) <= max_chars:
+        return text
     
-    return cleaned_text
+    logger.warning(f"{label} truncated from {len(text)} to {max_chars} characters")
+    return text[:max_chars]
 
 def extract_key_info_from_invoice(invoice_text: str) -> dict:
     """
@@ -218,20 +489,14 @@ def extract_key_info_from_invoice(invoice_text: str) -> dict:
         "estimated_amount": None
     }
     
-    lines = invoice_text.lower().split('\n')
+    # One pass over the text; stop as soon as every category has been seen
+    found = set()
+    for _, category in _KEY_INFO_AUTOMATON.iter(invoice_text.lower()):
+        found.add(category)
+        if len(found) == len(KEY_INFO_KEYWORDS):
+            break
     
-    # Look for common patterns
-    for line in lines:
-        # Check for date patterns
-        if any(word in line for word in ['date', 'dated', 'invoice date']):
-            key_info["has_date"] = True
-        
-        # Check for amount patterns
-        if any(symbol in line for symbol in ['$', '₹', 'rs', 'amount', 'total']):
-            key_info["has_amount"] = True
-            
-        # Check for vendor information
-        if any(word in line for word in ['vendor', 'company', 'ltd', 'inc', 'pvt']):
-            key_info["has_vendor"] = True
+    for category in found:
+        key_info[f"has_{category}"] = True
     
     return key_info
\ No newline at end of file